@@ -1,10 +1,20 @@
+import orjson
 import requests
-import csv
-from datetime import datetime, timedelta, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bisect import bisect_right
+from datetime import date, datetime, timedelta, timezone
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import chain
 from zoneinfo import ZoneInfo
 import os
+import queue
+import re
 import sys
+import threading
+import time
 
 # ================================
 # CONFIGURATION (ENV VARS)
@@ -13,171 +23,537 @@ STORE_NAME = os.getenv("SHOPIFY_STORE")
 API_TOKEN = os.getenv("SHOPIFY_API_TOKEN")
 API_VERSION = os.getenv("SHOPIFY_API_VERSION", "2026-01")
 
-if not STORE_NAME or not API_TOKEN:
-    print("❌ Missing SHOPIFY_STORE or SHOPIFY_API_TOKEN")
-    sys.exit(1)
-
 BASE_URL = f"https://{STORE_NAME}.myshopify.com/admin/api/{API_VERSION}"
 ORDERS_ENDPOINT = f"{BASE_URL}/orders.json"
+GRAPHQL_ENDPOINT = f"{BASE_URL}/graphql.json"
+
+# "1" = export orders with one GraphQL bulk operation (REST pages as fallback)
+USE_BULK_EXPORT = os.getenv("SHOPIFY_BULK_EXPORT", "1") == "1"
 
+# Accept-Encoding is left to requests: gzip/deflate always, plus br when the
+# brotli package is installed (see requirements.txt)
 HEADERS = {
     "X-Shopify-Access-Token": API_TOKEN,
+    "Accept": "application/json",
     "Content-Type": "application/json"
 }
 
 OUTPUT_FILE = "daily_summary.csv"
 
+# ================================
+# HTTP SESSION (POOLED + RETRIES)
+# ================================
+# One keep-alive connection is reused across pages instead of a fresh
+# TCP+TLS handshake per request. 429s honour Shopify's Retry-After.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True
+    )
+))
+
 # ================================
 # TIMEZONE (CLIENT: BERLIN)
 # ================================
 STORE_TZ = ZoneInfo("Europe/Berlin")
 
-# Last 30 days cutoff (Berlin time)
-now_berlin = datetime.now(STORE_TZ)
-cutoff_date = now_berlin - timedelta(days=30)
+# Report window length (Berlin days, counted back from now); override with
+# SHOPIFY_DAYS_RANGE, parsed in main() so a bad value never breaks import
+DEFAULT_DAYS_RANGE = 30
+# Sanity cap (huge values overflow the cutoff datetime). Shopify only returns
+# the last 60 days unless the token has the read_all_orders scope.
+MAX_DAYS_RANGE = 3650
 
 # ================================
-# FETCH ALL ORDERS (PAGINATED)
+# UTC → BERLIN DATE (FAST PATH)
 # ================================
-def fetch_all_orders():
-    orders = []
+# Python 3.11+ parses a trailing "Z" natively; older versions need "+00:00"
+if sys.version_info >= (3, 11):
+    parse_timestamp = datetime.fromisoformat
+else:
+    def parse_timestamp(value):
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+# The UTC instant of every Berlin midnight in the window is computed once;
+# an order's day is then one bisect over those edges instead of a ZoneInfo
+# conversion per order. DST never moves midnight, so edges are exact.
+def build_day_edges(first_day, last_day):
+    edges = []
+    labels = []
+
+    # One extra day so orders placed after midnight mid-run still bucket
+    for ordinal in range(first_day.toordinal(), last_day.toordinal() + 2):
+        day = date.fromordinal(ordinal)
+        edges.append(datetime(day.year, day.month, day.day, tzinfo=STORE_TZ).timestamp())
+        labels.append(day.isoformat())
+
+    return edges, labels
+
+# ================================
+# ERROR REPORTING
+# ================================
+# Shopify's 4xx bodies say what's wrong (bad token, missing scope). Slice the
+# bytes before decoding: under an incident the body can be a huge HTML page.
+def print_response_preview(error, limit=300):
+    response = getattr(error, "response", None)
+    if response is not None:
+        print(f"Response preview: {response.content[:limit].decode('utf-8', errors='replace')}")
+
+# REST slices fetch on parallel threads and tend to fail together (e.g. a bad
+# token); holding this keeps progress lines and multi-line reports in one piece
+REPORT_LOCK = threading.Lock()
+
+# ================================
+# FETCH ORDER PAGES (PAGINATED)
+# ================================
+# <https://...page_info=...>; rel="next" in Shopify's Link header
+LINK_NEXT_RE = re.compile(r'<([^>]+)>\s*;\s*[^,]*rel="next"')
+
+# First-page query (plus created_at_min); later pages carry it in the Link URL
+ORDERS_PARAMS = {
+    "status": "any",
+    "limit": 250,
+    "order": "created_at desc",
+    # Only what process_orders reads; refunds stay embedded (no N+1)
+    "fields": "id,created_at,total_price,refunds"
+}
+
+def iter_order_pages(created_at_min, created_at_max=None, stop=None):
     url = ORDERS_ENDPOINT
+    # Shopify drops orders outside the window server-side
     params = {
-        "status": "any",
-        "limit": 250,
-        "order": "created_at desc"
+        **ORDERS_PARAMS,
+        "created_at_min": created_at_min.isoformat(timespec="seconds")
     }
+    if created_at_max is not None:
+        params["created_at_max"] = created_at_max.isoformat(timespec="seconds")
 
+    label = created_at_min.strftime("%Y-%m-%d")
     page = 1
-
-    print("=" * 40)
-    print("🛒 Fetching Shopify orders")
-    print("📅 Filtering to last 30 days (Berlin time)")
-    print("=" * 40)
+    total = 0
 
     while url:
+        # Set when another slice failed: nobody will read this one
+        if stop is not None and stop.is_set():
+            return
+
         try:
-            response = requests.get(url, headers=HEADERS, params=params, timeout=30)
+            response = SESSION.get(url, params=params, timeout=30)
             response.raise_for_status()
         except Exception as e:
-            print(f"❌ API request failed on page {page}")
-            print(e)
+            with REPORT_LOCK:
+                print(f"❌ API request failed on page {page} ({label})")
+                print(e)
+                print_response_preview(e)
             sys.exit(1)
 
-        data = response.json()
+        data = orjson.loads(response.content)
         batch = data.get("orders", [])
-        orders.extend(batch)
+        total += len(batch)
 
-        print(f"✅ Page {page}: fetched {len(batch)} orders (total: {len(orders)})")
+        with REPORT_LOCK:
+            print(f"✅ Page {page} ({label}): fetched {len(batch)} orders (total: {total})")
 
         params = None  # IMPORTANT for pagination
 
-        link_header = response.headers.get("Link")
-        next_url = None
+        match = LINK_NEXT_RE.search(response.headers.get("Link", ""))
+        url = match.group(1) if match else None
+        page += 1
 
-        if link_header:
-            for link in link_header.split(","):
-                if 'rel="next"' in link:
-                    next_url = link.split(";")[0].strip("<> ")
+        yield batch
+
+# Pagination is strictly serial within a query, so the window is split into
+# contiguous created_at slices (one per worker by default) that page
+# independently. Each slice ends 1s before the next starts (bounds are
+# inclusive). 429s back off through the Session's Retry-After handling.
+def iter_order_pages_parallel(cutoff_date, days, max_workers=4, slices=None):
+    slices = slices or max_workers
+    # Whole seconds, so slice bounds line up with Shopify's second precision
+    slice_length = timedelta(seconds=days * 86400 // slices)
+    starts = [cutoff_date + slice_length * i for i in range(slices)]
+    windows = [
+        (start, next_start - timedelta(seconds=1))
+        for start, next_start in zip(starts, starts[1:])
+    ]
+    windows.append((starts[-1], None))  # open-ended up to now
+
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [
+            executor.submit(list, iter_order_pages(start, end, stop))
+            for start, end in windows
+        ]
+        for future in as_completed(futures):
+            yield from future.result()
+    finally:
+        # On failure, running slices stop after their current page and
+        # queued ones (when slices > max_workers) never start
+        stop.set()
+        executor.shutdown(cancel_futures=True)
 
-        url = next_url
-        page += 1
+# ================================
+# FETCH ORDERS (GRAPHQL BULK EXPORT)
+# ================================
+# One bulk operation exports every matching order to a JSONL file, replacing
+# the page-by-page REST walk. Order.transactions is a plain list (bulk
+# queries can't nest connections inside lists), so refunds are read there.
+BULK_ORDERS_QUERY = """
+{
+  orders(query: "created_at:>='%s'") {
+    edges {
+      node {
+        id
+        createdAt
+        totalPriceSet { shopMoney { amount } }
+        transactions { kind amountSet { shopMoney { amount } } }
+      }
+    }
+  }
+}
+"""
+
+BULK_RUN_MUTATION = """
+mutation($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+# Polled by id, so another run's operation can't be mistaken for ours
+BULK_STATUS_QUERY = """
+query($id: ID!) {
+  node(id: $id) {
+    ... on BulkOperation { id status errorCode objectCount url }
+  }
+}
+"""
+
+BULK_CANCEL_MUTATION = """
+mutation($id: ID!) {
+  bulkOperationCancel(id: $id) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+def graphql(query, variables=None):
+    response = SESSION.post(
+        GRAPHQL_ENDPOINT,
+        data=orjson.dumps({"query": query, "variables": variables or {}}),
+        timeout=30
+    )
+    response.raise_for_status()
+
+    body = orjson.loads(response.content)
+    if body.get("errors"):
+        raise RuntimeError(f"GraphQL errors: {body['errors']}")
+
+    return body["data"]
+
+def run_bulk_export(cutoff_date, poll_seconds=2, max_wait_seconds=600):
+    since = cutoff_date.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    data = graphql(BULK_RUN_MUTATION, {"query": BULK_ORDERS_QUERY % since})
+
+    result = data["bulkOperationRunQuery"]
+    if result["userErrors"]:
+        raise RuntimeError(f"Bulk operation rejected: {result['userErrors']}")
+
+    operation_id = result["bulkOperation"]["id"]
+    status = result["bulkOperation"]["status"]
+    print(f"⏳ Bulk operation started: {operation_id}")
+
+    # Bounded wait, so a stuck operation falls back to REST instead of
+    # hanging the workflow until Actions kills it
+    deadline = time.monotonic() + max_wait_seconds
+
+    try:
+        while True:
+            operation = graphql(BULK_STATUS_QUERY, {"id": operation_id})["node"]
+            if operation is None:
+                raise RuntimeError("Bulk operation disappeared while polling")
+
+            status = operation["status"]
+            if status == "COMPLETED":
+                print(f"✅ Bulk operation completed: {operation['objectCount']} objects")
+                return operation["url"]  # None when nothing matched
+            if status not in ("CREATED", "RUNNING"):
+                raise RuntimeError(f"Bulk operation {status}: {operation['errorCode']}")
+
+            if time.monotonic() >= deadline:
+                raise RuntimeError(
+                    f"Bulk operation still {status} after {max_wait_seconds}s"
+                )
+
+            time.sleep(poll_seconds)
+    except Exception:
+        # An abandoned operation would block the next run's bulkOperationRunQuery
+        if status in ("CREATED", "RUNNING"):
+            cancel_bulk_export(operation_id)
+        raise
+
+def cancel_bulk_export(operation_id):
+    try:
+        result = graphql(BULK_CANCEL_MUTATION, {"id": operation_id})["bulkOperationCancel"]
+        if result["userErrors"]:
+            print(f"⚠️ Bulk operation cancel rejected: {result['userErrors']}")
+        else:
+            print(f"🛑 Bulk operation cancelled: {operation_id}")
+    except Exception as e:
+        print(f"⚠️ Could not cancel bulk operation {operation_id}")
+        print(e)
+
+def bulk_node_to_order(node):
+    refund_transactions = [
+        {"kind": "refund", "amount": tx["amountSet"]["shopMoney"]["amount"]}
+        for tx in node.get("transactions") or ()
+        if tx["kind"] == "REFUND"
+    ]
+    # Same shape as a REST order, so process_orders handles both sources;
+    # no refunds means an empty list, so the refund loop is skipped
+    return {
+        "created_at": node["createdAt"],
+        "total_price": node["totalPriceSet"]["shopMoney"]["amount"],
+        "refunds": [{"transactions": refund_transactions}] if refund_transactions else []
+    }
+
+# Opened eagerly (not inside the lazy generator below), so a failed download
+# surfaces in main's try and falls back to REST before any order is counted
+def open_bulk_export(url):
+    if not url:
+        return None
+
+    # Signed storage URL: don't forward the Shopify access token
+    response = SESSION.get(
+        url,
+        headers={"X-Shopify-Access-Token": None},
+        stream=True,
+        timeout=60
+    )
+    response.raise_for_status()
+
+    return response
+
+def iter_bulk_order_pages(response, batch_size=250):
+    if response is None:
+        return
 
-    return orders
+    batch = []
+    total = 0
+
+    for line in response.iter_lines(chunk_size=1 << 16):
+        if not line:
+            continue
+        batch.append(bulk_node_to_order(orjson.loads(line)))
+
+        if len(batch) == batch_size:
+            total += len(batch)
+            print(f"✅ Bulk export: read {total} orders")
+            yield batch
+            batch = []
+
+    if batch:
+        total += len(batch)
+        print(f"✅ Bulk export: read {total} orders")
+        yield batch
+
+# ================================
+# PREFETCH PAGES IN BACKGROUND
+# ================================
+# The next page downloads while the current one is aggregated. At most
+# `depth` pages are buffered; worker failures (incl. sys.exit) re-raise here.
+_END_OF_PAGES = object()
+
+def prefetch_pages(pages, depth=2):
+    q = queue.Queue(maxsize=depth)
+
+    def produce():
+        try:
+            for batch in pages:
+                q.put(batch)
+        except BaseException as e:
+            q.put(e)
+        else:
+            q.put(_END_OF_PAGES)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    while True:
+        item = q.get()
+        if item is _END_OF_PAGES:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+# ================================
+# MONEY AS INTEGER CENTS
+# ================================
+# Shopify sends amounts as decimal strings ("12.5", "49.90"). Summing cents
+# as ints is exact, so no float drift and no round() at write time.
+def to_cents(amount):
+    if amount.startswith("-"):
+        return -to_cents(amount[1:])
+    whole, _, frac = amount.partition(".")
+    return int(whole or "0") * 100 + int((frac + "00")[:2])
 
 # ================================
 # PROCESS ORDERS INTO DAILY TOTALS
 # ================================
-def process_orders(orders):
-    daily_data = defaultdict(lambda: {
-        "revenue": 0.0,
-        "refunds": 0.0,
-        "orders": 0
-    })
+def process_orders(pages, cutoff_date, now_berlin, days):
+    # One dict per column (keyed by day) instead of a dict per day
+    revenue = defaultdict(int)
+    refunds = defaultdict(int)
+    order_count = defaultdict(int)
 
     # ------------------------------------------------
     # 1️⃣ PRE-FILL ALL DAYS (INCLUDING 0-ORDER DAYS)
     # ------------------------------------------------
-    start_date = cutoff_date.date()
-    end_date = now_berlin.date()
+    day_edges, day_labels = build_day_edges(cutoff_date.date(), now_berlin.date())
 
-    current_date = start_date
-    while current_date <= end_date:
-        date_key = current_date.strftime("%Y-%m-%d")
-        daily_data[date_key]  # initialize zeros
-        current_date += timedelta(days=1)
+    for date_key in day_labels[:-1]:
+        # initialize zeros
+        revenue[date_key]
+        refunds[date_key]
+        order_count[date_key]
 
     # ------------------------------------------------
     # 2️⃣ APPLY ORDERS
     # ------------------------------------------------
-    kept = 0
+    cutoff_ts = cutoff_date.timestamp()
+    # A timestamp's own date is within a day of its Berlin date (offsets are
+    # under ±24h), so anything dated earlier than this is safely too old
+    too_old_before = (cutoff_date.date() - timedelta(days=1)).isoformat()
 
-    for order in orders:
-        created_utc = datetime.fromisoformat(
-            order["created_at"].replace("Z", "+00:00")
-        )
+    # Hot-loop globals bound to locals
+    parse_ts = parse_timestamp
+    # Prices repeat a lot (same SKUs), so parse each distinct string once
+    cents = lru_cache(maxsize=4096)(to_cents)
+    refund_kind = "refund"
 
-        # Convert to Berlin time
-        created_berlin = created_utc.astimezone(STORE_TZ)
+    # created_at -> Berlin day, or None before the cutoff. Orders placed in
+    # the same second share the string, so repeats skip the parse entirely.
+    @lru_cache(maxsize=None)
+    def day_of(created_at):
+        if created_at[:10] < too_old_before:
+            return None
 
-        if created_berlin < cutoff_date:
-            continue
+        created_ts = parse_ts(created_at).timestamp()
+
+        if created_ts < cutoff_ts:
+            return None
+
+        # Last Berlin midnight at or before the order
+        return day_labels[bisect_right(day_edges, created_ts) - 1]
 
-        date_key = created_berlin.strftime("%Y-%m-%d")
-        revenue = float(order["total_price"])
+    fetched = 0
+    kept = 0
+
+    for order in chain.from_iterable(pages):
+        fetched += 1
 
-        daily_data[date_key]["revenue"] += revenue
-        daily_data[date_key]["orders"] += 1
+        date_key = day_of(order["created_at"])
+        if date_key is None:
+            continue
 
-        for refund in order.get("refunds", []):
-            for tx in refund.get("transactions", []):
-                if tx.get("kind") == "refund":
-                    daily_data[date_key]["refunds"] += float(tx["amount"])
+        revenue[date_key] += cents(order["total_price"])
+        order_count[date_key] += 1
+
+        order_refunds = order.get("refunds")
+        if order_refunds:
+            refunded = 0
+            for refund in order_refunds:
+                for tx in refund["transactions"]:
+                    if tx["kind"] == refund_kind:
+                        refunded += cents(tx["amount"])
+            refunds[date_key] += refunded
 
         kept += 1
 
-    print(f"📦 Orders within last 30 days: {kept}")
-    print(f"📅 Days generated (incl. zero-order days): {len(daily_data)}")
+    print(f"📦 Total orders fetched (server-filtered window): {fetched}")
+    print(f"📦 Orders within last {days} days: {kept}")
+    print(f"📅 Days generated (incl. zero-order days): {len(order_count)}")
 
-    return daily_data
+    return revenue, refunds, order_count
 
 # ================================
 # WRITE CSV
 # ================================
-def write_csv(daily_data):
-    with open(OUTPUT_FILE, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow([
-            "date",
-            "revenue",
-            "refunds",
-            "net_revenue",
-            "order_count"
-        ])
-
-        for date in sorted(daily_data.keys()):
-            revenue = daily_data[date]["revenue"]
-            refunds = daily_data[date]["refunds"]
-            net_revenue = revenue - refunds
-            orders = daily_data[date]["orders"]
-
-            writer.writerow([
-                date,
-                round(revenue, 2),
-                round(refunds, 2),
-                round(net_revenue, 2),
-                orders
-            ])
+# Every field is an ISO date, a number or an int, so nothing ever needs
+# quoting and rows can be formatted directly (same \r\n as csv.writer).
+CSV_HEADER = "date,revenue,refunds,net_revenue,order_count\r\n"
+DAY_KEY_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+def write_csv(revenue, refunds, order_count, path=OUTPUT_FILE):
+    # Days are pre-filled oldest-first and orders can only add a later day
+    # (placed after midnight mid-run), so insertion order is already sorted
+    days = list(order_count)
+    assert all(DAY_KEY_RE.fullmatch(day) for day in days)
+
+    body = "".join(
+        f"{day},{revenue[day] / 100:.2f},{refunds[day] / 100:.2f},"
+        f"{(revenue[day] - refunds[day]) / 100:.2f},{order_count[day]}\r\n"
+        for day in days
+    )
+
+    # Whole file goes out in one buffered write
+    with open(path, "w", newline="", encoding="utf-8", buffering=1 << 20) as csvfile:
+        csvfile.write(CSV_HEADER + body)
 
 # ================================
 # MAIN
 # ================================
 def main():
-    orders = fetch_all_orders()
-    print(f"📦 Total orders fetched (all time): {len(orders)}")
+    if not STORE_NAME or not API_TOKEN:
+        print("❌ Missing SHOPIFY_STORE or SHOPIFY_API_TOKEN")
+        sys.exit(1)
+
+    # Empty counts as unset (an undefined workflow variable expands to "")
+    try:
+        days = int(os.getenv("SHOPIFY_DAYS_RANGE") or DEFAULT_DAYS_RANGE)
+    except ValueError:
+        days = 0
+
+    if not 1 <= days <= MAX_DAYS_RANGE:
+        print(f"❌ SHOPIFY_DAYS_RANGE must be a whole number from 1 to {MAX_DAYS_RANGE}")
+        sys.exit(1)
+
+    # Last `days` days cutoff (Berlin time)
+    now_berlin = datetime.now(STORE_TZ)
+    cutoff_date = now_berlin - timedelta(days=days)
+
+    print("=" * 40)
+    print("🛒 Fetching Shopify orders")
+    print(f"📅 Filtering to last {days} days (Berlin time)")
+    print("=" * 40)
+
+    pages = None
+
+    if USE_BULK_EXPORT:
+        try:
+            response = open_bulk_export(run_bulk_export(cutoff_date))
+            pages = iter_bulk_order_pages(response)
+        except Exception as e:
+            print("⚠️ Bulk export failed, falling back to REST pages")
+            print(e)
+            print_response_preview(e)
+
+    if pages is None:
+        pages = iter_order_pages_parallel(cutoff_date, days)
 
-    daily_data = process_orders(orders)
-    write_csv(daily_data)
+    revenue, refunds, order_count = process_orders(
+        prefetch_pages(pages), cutoff_date, now_berlin, days
+    )
+    write_csv(revenue, refunds, order_count)
 
     print("=" * 40)
     print(f"✅ CSV generated: {OUTPUT_FILE}")